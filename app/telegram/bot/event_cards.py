@@ -0,0 +1,42 @@
+from collections import namedtuple
+
+"""
+=============================================================================================
+EventCard: Everything needed to send an event: the caption, its Markdown-safe version, the
+    "Register for Event" keyboard and the event photo. Cards are immutable and shared by all users
+EventCardCache: Renders each event of an EventIndex into a card once per catalogue version.
+    When the catalogue changes only the events that were added or changed are re-rendered
+=============================================================================================
+"""
+
+EventCard = namedtuple("EventCard", ["event_id", "event", "caption", "escaped_caption", "reply_markup", "photo"])
+
+
+class EventCardCache:
+    def __init__(self, render_card):
+        self.render_card = render_card  # render_card(event_id, event) -> EventCard
+        self.version = None  # EventIndex.version the cards were rendered for
+        self.cards = []  # Cards in catalogue order
+        self._cards = {}  # event id -> card
+
+    def get_cards(self, event_index):
+        if self.version == event_index.version:
+            return self.cards
+
+        cards = {}
+        for event_id in event_index.ordered_ids:
+            event = event_index.events[event_id]
+            card = self._cards.get(event_id)
+            # The index only replaces an event object when the event has changed
+            if card is None or card.event is not event:
+                card = self.render_card(event_id, event)
+            cards[event_id] = card
+
+        self._cards = cards
+        self.cards = list(cards.values())
+        self.version = event_index.version
+        return self.cards
+
+    def get_card(self, event_index, event_id):
+        self.get_cards(event_index)
+        return self._cards.get(event_id)
@@ -0,0 +1,121 @@
+import hashlib
+import re
+import time
+
+"""
+=============================================================================================
+get_event_id: Compact id of an event, short enough to be used in deep links and callback data
+tokenize: Split text into lowercase search tokens
+EventIndex: In-memory token/prefix index over the title, description and venue of each event.
+    update() diffs a fresh /viewEvents catalogue against the indexed one and only re-indexes
+    events that were added, changed or removed. search() answers a query with one dict lookup
+    per query token and returns a page of events ordered by title
+=============================================================================================
+"""
+
+INDEXED_FIELDS = ('title', 'description', 'venue')
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def get_event_id(event):
+    event_id = event.get('id')
+    if event_id and len(event_id) <= 20:
+        return event_id
+    # Events without a (short) Firestore document id are identified by a hash of their title
+    return hashlib.sha1(event['title'].encode()).hexdigest()[:10]
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class EventIndex:
+    def __init__(self, max_prefix_length=15):
+        self.max_prefix_length = max_prefix_length
+        self.events = {}  # event id -> event
+        self.version = 0  # Incremented whenever the indexed catalogue changes
+        self.updated_at = 0  # time.monotonic() of the last update
+        self.ordered_ids = []  # event ids ordered by title
+        self._fingerprints = {}  # event id -> fields the index was built from
+        self._prefixes = {}  # event id -> prefixes the event is posted under
+        self._postings = {}  # prefix -> set of event ids
+        self._ranks = {}  # event id -> position in ordered_ids
+
+    def __len__(self):
+        return len(self.events)
+
+    def get(self, event_id):
+        return self.events.get(event_id)
+
+    def update(self, events):
+        """Sync the index with a full catalogue and return the ids of the changed events"""
+        self.updated_at = time.monotonic()
+        catalogue = {get_event_id(event): event for event in events}
+        changed = set()
+
+        for event_id in self.events.keys() - catalogue.keys():
+            self._remove(event_id)
+            changed.add(event_id)
+
+        for event_id, event in catalogue.items():
+            fingerprint = tuple(sorted(event.items(), key=lambda item: item[0]))
+            if self._fingerprints.get(event_id) == fingerprint:
+                continue
+            if event_id in self.events:
+                self._remove(event_id)
+            self._add(event_id, event, fingerprint)
+            changed.add(event_id)
+
+        if changed:
+            self.version += 1
+            self.ordered_ids = sorted(self.events, key=lambda event_id: str(self.events[event_id]['title']).lower())
+            self._ranks = {event_id: rank for rank, event_id in enumerate(self.ordered_ids)}
+        return changed
+
+    def search(self, query, offset=0, limit=10):
+        """Return (events, next_offset) for the events matching every token in the query.
+
+        Each query token matches any indexed token starting with it. next_offset is None
+        once the last page has been returned.
+        """
+        tokens = tokenize(query)
+        if tokens:
+            matches = None
+            for token in tokens:
+                postings = self._postings.get(token[:self.max_prefix_length], set())
+                matches = postings if matches is None else matches & postings
+                if not matches:
+                    return [], None
+            ordered = sorted(matches, key=self._ranks.__getitem__)
+        else:
+            ordered = self.ordered_ids
+
+        page = ordered[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(ordered) else None
+        return [self.events[event_id] for event_id in page], next_offset
+
+    def _add(self, event_id, event, fingerprint):
+        prefixes = set()
+        for field in INDEXED_FIELDS:
+            value = event.get(field)
+            if value is None: # e.g. an event without a venue, which must not match "none"
+                continue
+            for token in tokenize(value):
+                for end in range(1, min(len(token), self.max_prefix_length) + 1):
+                    prefixes.add(token[:end])
+        for prefix in prefixes:
+            self._postings.setdefault(prefix, set()).add(event_id)
+
+        self.events[event_id] = event
+        self._fingerprints[event_id] = fingerprint
+        self._prefixes[event_id] = prefixes
+
+    def _remove(self, event_id):
+        for prefix in self._prefixes.pop(event_id):
+            postings = self._postings[prefix]
+            postings.discard(event_id)
+            if not postings:
+                del self._postings[prefix]
+
+        del self.events[event_id]
+        del self._fingerprints[event_id]
@@ -0,0 +1,86 @@
+import os
+
+import tornado.httpserver
+import tornado.web
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+from bot_logging import get_update_latency_ms
+
+"""
+=============================================================================================
+Metrics of running bots, served as JSON at GET /metrics by user_bot.py and multi_tenant_bot.py.
+    add_metrics_handlers: Count the updates, errors and handling latency of a bot
+    get_transport_stats: Requests sent and time spent waiting for a pooled Telegram connection, per traffic class
+    get_bot_metrics: Counters, update queue size, mint queue depth & throughput, Telegram transport
+        and wallet ledger stats of a bot
+    start_metrics_server: Serve the metrics of bots on METRICS_ADDRESS:METRICS_PORT (default: 127.0.0.1:9090).
+        Metrics are not public, so they are never served next to the webhook routes
+=============================================================================================
+"""
+
+METRICS_ADDRESS = os.getenv("METRICS_ADDRESS", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.bot_data["metrics"]["updates"] += 1
+
+
+async def record_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    latency_ms = get_update_latency_ms()
+    if latency_ms is not None:
+        metrics = context.bot_data["metrics"]
+        metrics["handling_ms_total"] += latency_ms
+        metrics["handling_ms_max"] = max(metrics["handling_ms_max"], latency_ms)
+
+
+async def count_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    context.bot_data["metrics"]["errors"] += 1
+
+
+def add_metrics_handlers(application):
+    application.bot_data["metrics"] = {
+        "updates": 0, "errors": 0, "handling_ms_total": 0.0, "handling_ms_max": 0.0,
+    }
+    application.add_handler(TypeHandler(Update, count_update), group=-2)
+    application.add_handler(TypeHandler(Update, record_update_latency), group=2)
+    application.add_error_handler(count_error)
+
+
+def get_transport_stats(application):
+    return {name: request.get_stats() for name, request in application.bot_data["bot_requests"].items()}
+
+
+async def get_bot_metrics(application):
+    metrics = dict(application.bot_data["metrics"])
+    updates = metrics["updates"]
+    metrics["handling_ms_avg"] = metrics["handling_ms_total"] / updates if updates else 0.0
+    metrics["update_queue_size"] = application.update_queue.qsize()
+    if "mint_queue" in application.bot_data:
+        metrics["mint_queue"] = await application.bot_data["mint_queue"].get_stats()
+    metrics["telegram_transport"] = get_transport_stats(application)
+    if "wallet_ledger" in application.bot_data:
+        metrics["wallet_ledger"] = application.bot_data["wallet_ledger"].stats
+    return metrics
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, applications):
+        self.applications = applications
+
+    async def get(self):
+        metrics = {}
+        for application in self.applications:
+            name = application.bot_data.get("tenant") or application.bot.username
+            metrics[name] = await get_bot_metrics(application)
+        self.write(metrics)
+
+
+def start_metrics_server(applications):
+    """Serve the metrics of applications (keyed by tenant name or bot username). Returns the server to stop"""
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/metrics", MetricsHandler, {"applications": applications}),
+    ]))
+    server.listen(METRICS_PORT, address=METRICS_ADDRESS)
+    return server
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+"""
+=============================================================================================
+MintQueue: Durable background queue of NFT mint jobs, one per (user, event).
+    enqueue: Persist a mint job. A job for a user & event that is already queued (or minted) is coalesced,
+        a job that failed is queued again
+    run: Worker loop claiming due jobs with bounded concurrency. A job calls /mintNft and saves the mint account
+        on the registration (/updateRegistration), like the merchant raffle does. The registration is read
+        first, so one that already has a mint_account is not minted again. Failed jobs are retried with
+        exponential backoff (without minting again once a mint account was received), and the user's chat
+        is notified once the job completes
+    get_stats: Queue depth per status and mint throughput
+Jobs live in a SQLite file so that they survive restarts; jobs left running by a crash are re-queued on start.
+The database is only used from a dedicated thread, so its queries and commits (fsync) never block the event loop.
+The worker sleeps until a job is enqueued, a mint completes or the next retry is due, instead of polling.
+Backend requests use the queue's own async connection pool (one connection per concurrent job), so slow mints
+cannot hold up the backend requests of update handlers.
+=============================================================================================
+"""
+
+logger = logging.getLogger(__name__)
+
+MINT_TIMEOUT = 120  # Seconds before a /mintNft request is abandoned
+THROUGHPUT_WINDOW = 60  # Seconds of successful mints counted in mints_per_minute
+
+PENDING, RUNNING, MINTED, FAILED = "PENDING", "RUNNING", "MINTED", "FAILED"
+
+
+class MintQueue:
+    def __init__(self, db_path, endpoint_url, bot=None, concurrency=4, max_attempts=5, retry_delay=5):
+        self.endpoint_url = endpoint_url
+        self.client = httpx.AsyncClient(
+            base_url=endpoint_url, timeout=MINT_TIMEOUT,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        self.bot = bot  # Used to notify users, can be None
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay  # Seconds before the first retry, doubled on every attempt
+        self.minted_times = deque()  # time.monotonic() of the successful mints in the last THROUGHPUT_WINDOW, for throughput
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()  # In-flight _process tasks
+        self.db_path = db_path
+        self.db = None  # Opened by start()
+        self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mint-db")
+
+    def _open(self):
+        # check_same_thread is off as the connection is opened and used by the same single executor thread,
+        # which is not necessarily the thread that created the executor
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS mint_jobs ("
+            "user_id TEXT, event_title TEXT, chat_id INTEGER, status TEXT, attempts INTEGER DEFAULT 0, "
+            "next_attempt_at REAL, last_error TEXT, mint_account TEXT, PRIMARY KEY (user_id, event_title))"
+        )
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(mint_jobs)")]
+        if 'mint_account' not in columns: # Job databases created before mint accounts were saved
+            self.db.execute("ALTER TABLE mint_jobs ADD COLUMN mint_account TEXT")
+        # Jobs that were running when the process stopped have not completed
+        self.db.execute("UPDATE mint_jobs SET status = ? WHERE status = ?", (PENDING, RUNNING))
+        self.db.commit()
+
+    async def _run_db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, function, *args)
+
+    def _write(self, sql, parameters):
+        cursor = self.db.execute(sql, parameters)
+        self.db.commit()
+        return cursor.rowcount
+
+    async def enqueue(self, user_id, event_title, chat_id=None):
+        """Queue a mint job and return True, or False if it was coalesced into an existing job"""
+        rowcount = await self._run_db(
+            self._write,
+            "INSERT INTO mint_jobs (user_id, event_title, chat_id, status, next_attempt_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, event_title) DO UPDATE SET status = excluded.status, attempts = 0, "
+            "next_attempt_at = excluded.next_attempt_at, chat_id = excluded.chat_id WHERE status = ?",
+            (str(user_id), event_title, chat_id, PENDING, time.time(), FAILED),
+        )
+        self._wakeup.set()
+        return rowcount == 1
+
+    async def start(self):
+        await self._run_db(self._open)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=MINT_TIMEOUT):
+        """Stop claiming jobs, wait up to timeout seconds for in-flight mints and close the database"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._running:
+            _, pending = await asyncio.wait(self._running, timeout=timeout)
+            for task in pending:
+                # Left RUNNING, so these are retried on the next start
+                logger.warning("Cancelling an NFT mint that did not complete before shutdown")
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        if self.db:
+            await self._run_db(self.db.close)
+        self._db_executor.shutdown()
+        await self.client.aclose()
+
+    async def run(self):
+        running = self._running
+        while True:
+            # Cleared before claiming, so that a job enqueued while claiming wakes the next wait
+            self._wakeup.clear()
+            timeout = None
+            free = self.concurrency - len(running)
+            if free > 0:
+                jobs, next_attempt_at = await self._run_db(self._claim, free)
+                for job in jobs:
+                    running.add(asyncio.create_task(self._process(*job)))
+                if next_attempt_at is not None:
+                    timeout = max(next_attempt_at - time.time(), 0)
+
+            waiters = [asyncio.create_task(self._wakeup.wait()), *running]
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            waiters[0].cancel()
+            running -= done
+
+    def _claim(self, limit):
+        """Mark up to limit due jobs RUNNING. Returns them with the time the next pending job is due (or None)"""
+        jobs = self.db.execute(
+            "SELECT user_id, event_title, chat_id, attempts, mint_account FROM mint_jobs "
+            "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (PENDING, time.time(), limit),
+        ).fetchall()
+        self.db.executemany(
+            "UPDATE mint_jobs SET status = ? WHERE user_id = ? AND event_title = ?",
+            [(RUNNING, user_id, event_title) for user_id, event_title, *_ in jobs],
+        )
+        self.db.commit()
+        next_attempt_at, = self.db.execute(
+            "SELECT MIN(next_attempt_at) FROM mint_jobs WHERE status = ?", (PENDING,)
+        ).fetchone()
+        return jobs, next_attempt_at
+
+    async def _process(self, user_id, event_title, chat_id, attempts, mint_account):
+        logger.info(f"Minting NFT for {user_id} ({event_title}), attempt {attempts + 1}")
+        try:
+            registration = await self._get_registration(user_id, event_title)
+            if registration.get('mint_account'):
+                logger.info(f"NFT for {user_id} ({event_title}) was already minted to {registration['mint_account']}")
+            else:
+                if not mint_account:
+                    mint_account = await self._mint(user_id, event_title)
+                    await self._run_db(
+                        self._write,
+                        "UPDATE mint_jobs SET mint_account = ? WHERE user_id = ? AND event_title = ?",
+                        (mint_account, user_id, event_title),
+                    )
+                await self._request("post", "/updateRegistration", json={
+                    'user_id': user_id, 'event_title': event_title,
+                    'status': registration['status'], 'mint_account': mint_account,
+                })
+        except Exception as e:
+            await self._retry(user_id, event_title, attempts + 1, str(e) or type(e).__name__) # httpx timeouts have no message
+            return
+
+        await self._run_db(
+            self._write,
+            "UPDATE mint_jobs SET status = ?, attempts = ?, last_error = NULL WHERE user_id = ? AND event_title = ?",
+            (MINTED, attempts + 1, user_id, event_title),
+        )
+        self._prune_minted_times()
+        self.minted_times.append(time.monotonic())
+
+        if self.bot and chat_id:
+            try:
+                await self.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"Your NFT ticket for {event_title} has been minted to your Mynt wallet!"
+                )
+            except Exception as e:
+                logger.error(f"Error notifying {user_id} of minted NFT: {e}")
+
+    async def _request(self, method, path, **kwargs):
+        response = await self.client.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def _get_registration(self, user_id, event_title):
+        response = await self._request("get", f"/getRegistrations/{user_id}")
+        for registration in response.json():
+            if registration['eventTitle'] == event_title:
+                return registration
+        raise LookupError(f"No registration of {user_id} for {event_title}")
+
+    async def _mint(self, user_id, event_title):
+        response = await self._request("post", "/mintNft", json={'user_id': user_id, 'event_title': event_title})
+        # /mintNft answers 200 without a body when minting fails
+        mint_account = response.json().get('mintAccount') if response.content else None
+        if not mint_account:
+            raise ValueError("/mintNft returned no mint account")
+        return mint_account
+
+    async def _retry(self, user_id, event_title, attempts, error):
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up minting NFT for {user_id} ({event_title}) after {attempts} attempts: {error}")
+            status, next_attempt_at = FAILED, None
+        else:
+            logger.warning(f"Error minting NFT for {user_id} ({event_title}): {error}")
+            status, next_attempt_at = PENDING, time.time() + self.retry_delay * 2 ** (attempts - 1)
+        await self._run_db(
+            self._write,
+            "UPDATE mint_jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+            "WHERE user_id = ? AND event_title = ?",
+            (status, attempts, next_attempt_at, error, user_id, event_title),
+        )
+
+    def _prune_minted_times(self):
+        now = time.monotonic()
+        while self.minted_times and now - self.minted_times[0] > THROUGHPUT_WINDOW:
+            self.minted_times.popleft()
+
+    def _count_jobs(self):
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM mint_jobs GROUP BY status").fetchall())
+
+    async def get_stats(self):
+        self._prune_minted_times()
+        counts = await self._run_db(self._count_jobs)
+        return {
+            'queue_depth': counts.get(PENDING, 0) + counts.get(RUNNING, 0),
+            'pending': counts.get(PENDING, 0),
+            'running': counts.get(RUNNING, 0),
+            'minted': counts.get(MINTED, 0),
+            'failed': counts.get(FAILED, 0),
+            'mints_per_minute': len(self.minted_times) * 60 / THROUGHPUT_WINDOW,
+        }
+
+
+if __name__ == '__main__':
+    # Run a few jobs against a local stub of the backend where every other /mintNft call fails and the
+    # first /updateRegistration call fails after its mint succeeded
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    registrations = {str(user_id): {'userId': str(user_id), 'eventTitle': "Jazz Night", 'status': "SUCCESSFUL"}
+                     for user_id in range(5)}
+    calls = {'/mintNft': 0, '/updateRegistration': 0}
+
+    class StubBackendHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.reply(200, [registrations[self.path.rsplit('/', 1)[-1]]])
+
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            calls[self.path] += 1
+            if self.path == "/mintNft":
+                if calls[self.path] % 2:
+                    self.reply(500, {})
+                else:
+                    self.reply(200, {'mintAccount': f"mint-{calls[self.path]}"})
+            elif calls[self.path] == 1:
+                self.reply(500, {})
+            else:
+                registrations[data['user_id']].update(status=data['status'], mint_account=data['mint_account'])
+                self.reply(200, {})
+
+        def reply(self, status, body):
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("localhost", 0), StubBackendHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    async def main():
+        queue = MintQueue(":memory:", f"http://localhost:{server.server_port}", retry_delay=0.1)
+        await queue.start()
+        for user_id in range(5):
+            await queue.enqueue(user_id, "Jazz Night")
+        print("coalesced:", not await queue.enqueue(0, "Jazz Night"))
+        while (await queue.get_stats())['queue_depth']:
+            await asyncio.sleep(0.1)
+        print("stub calls:", calls, "stats:", await queue.get_stats())
+        print("mint accounts:", sorted(registration.get('mint_account') for registration in registrations.values()))
+        await queue.stop()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
+    server.shutdown()
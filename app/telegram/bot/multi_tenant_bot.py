@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+
+import tornado.httpserver
+import tornado.web
+from telegram import Update
+
+from metrics import METRICS_ADDRESS, METRICS_PORT, start_metrics_server
+from user_bot import build_application, post_init, post_shutdown, PORT
+
+"""
+=============================================================================================
+Runs the bots of many merchants (tenants) in one process and event loop.
+
+Tenants are read from TENANTS_FILE (default: tenants.json), a JSON list of objects with
+    name, token, and optionally provider_token, endpoint_url, currency & mint_db (defaults from .env)
+Each tenant gets its own Application, so user_data, bot_data and the caches kept in bot_data
+(e.g. the event search index) are partitioned by tenant. Each tenant also has its own backend
+connection pool (BACKEND_POOL_SIZE) and mint queue pool, so a slow tenant backend cannot stall the others.
+
+With WEBHOOK_URL set, one web server receives the updates of every tenant and routes them by
+token path (WEBHOOK_URL + token), otherwise every tenant polls. A tenant that fails to start (e.g. a
+revoked token) is logged and skipped, the other tenants keep running.
+
+GET /metrics returns the metrics of every tenant (see metrics.py). It is served by a separate server on
+METRICS_ADDRESS:METRICS_PORT (default: 127.0.0.1:9090), not next to the public webhook routes.
+=============================================================================================
+"""
+
+logger = logging.getLogger(__name__)
+
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+webhook_url = os.getenv("WEBHOOK_URL")
+
+
+def load_tenants(path):
+    with open(path) as file:
+        tenants = json.load(file)
+    for tenant in tenants:
+        if not tenant.get('token'):
+            raise ValueError(f"Tenant {tenant.get('name')} has no bot token")
+        tenant.setdefault('name', tenant['token'].split(':')[0])
+    return tenants
+
+
+def build_tenant_application(tenant):
+    config = {key: tenant[key] for key in ('provider_token', 'endpoint_url', 'currency', 'mint_db') if key in tenant}
+    config.setdefault('mint_db', f"mint_jobs_{tenant['name']}.db")
+    application = build_application(tenant['token'], config)
+    application.bot_data["tenant"] = tenant['name']
+    return application
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, applications):
+        self.applications = applications
+
+    async def post(self, token):
+        application = self.applications.get(token)
+        if application is None:
+            raise tornado.web.HTTPError(404)
+        update = Update.de_json(json.loads(self.request.body), application.bot)
+        await application.update_queue.put(update)
+        self.set_status(200)
+
+
+async def start_tenant(token, application):
+    await application.initialize()
+    # Application.post_init only runs with run_polling/run_webhook. Like there, it runs before any
+    # update is fetched, so the bulk bot and mint queue exist when handlers need them
+    await post_init(application)
+    if webhook_url:
+        await application.bot.set_webhook(url=webhook_url + token)
+    else:
+        await application.updater.start_polling()
+    await application.start()
+    logger.info(f"Started tenant {application.bot_data['tenant']} (@{application.bot.username})")
+
+
+async def stop_tenant(application):
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await post_shutdown(application)
+    await application.shutdown()
+
+
+async def run(tenants):
+    applications = {}
+    for tenant in tenants:
+        application = build_tenant_application(tenant)
+        try:
+            await start_tenant(tenant['token'], application)
+        except Exception:
+            # e.g. InvalidToken for a revoked or mistyped token, which must not take down the other tenants
+            logger.exception(f"Skipping tenant {tenant['name']}, it failed to start")
+            try:
+                await stop_tenant(application)
+            except Exception:
+                logger.exception(f"Error cleaning up tenant {tenant['name']}")
+            continue
+        applications[tenant['token']] = application
+
+    if not applications:
+        logger.error("No tenant could be started")
+        return
+
+    webhook_server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/([^/]+)", WebhookHandler, {"applications": applications}),
+    ]))
+    webhook_server.listen(PORT, address="0.0.0.0")
+    metrics_server = start_metrics_server(list(applications.values()))
+    logger.info(
+        f"Running {len(applications)} of {len(tenants)} tenants via {'webhook' if webhook_url else 'polling'}, "
+        f"metrics on {METRICS_ADDRESS}:{METRICS_PORT}"
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    webhook_server.stop()
+    metrics_server.stop()
+    for application in applications.values():
+        await stop_tenant(application)
+
+
+if __name__ == '__main__':
+    asyncio.run(run(load_tenants(TENANTS_FILE)))
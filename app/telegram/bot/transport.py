@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+
+"""
+=============================================================================================
+Outbound Telegram Bot API transport.
+
+Traffic is split into classes, each with its own connection pool so that one class cannot
+starve another:
+    updates: getUpdates long polling
+    interactive: replies sent while handling an update (send_message, edit_message_text, send_invoice...)
+    bulk: notifications sent outside of an update, e.g. by the mint queue
+PooledRequest: HTTPXRequest that applies per-method timeouts (METHOD_TIMEOUTS) and records how long
+    requests wait for a free connection
+build_bot_requests: Build the request of every traffic class, sized from the number of updates
+    handled concurrently
+=============================================================================================
+"""
+
+# Timeouts (seconds) per Bot API method when the caller does not pass its own
+MEDIA_TIMEOUTS = {'read_timeout': 20.0, 'write_timeout': 20.0}
+METHOD_TIMEOUTS = {
+    'sendPhoto': MEDIA_TIMEOUTS,
+    'sendDocument': MEDIA_TIMEOUTS,
+    'sendInvoice': {'read_timeout': 10.0},
+    'answerCallbackQuery': {'read_timeout': 3.0},
+    'answerInlineQuery': {'read_timeout': 3.0},
+    'answerPreCheckoutQuery': {'read_timeout': 3.0},  # Telegram only waits 10s for the answer
+}
+
+
+class PooledRequest(HTTPXRequest):
+    def __init__(self, name, connection_pool_size, method_timeouts=None, pool_timeout=1.0, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, pool_timeout=pool_timeout, **kwargs)
+        self.name = name
+        self.connection_pool_size = connection_pool_size
+        self.pool_timeout = pool_timeout
+        self.method_timeouts = method_timeouts or {}
+        # One slot per pooled connection, so that the time spent waiting for a connection can be measured
+        self._slots = asyncio.Semaphore(connection_pool_size)
+        self.stats = {'requests': 0, 'waiting': 0, 'pool_wait_ms_total': 0.0, 'pool_wait_ms_max': 0.0}
+
+    async def do_request(self, url, method, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        timeouts = self.method_timeouts.get(url.rsplit('/', 1)[-1], {})
+        if read_timeout is BaseRequest.DEFAULT_NONE:
+            read_timeout = timeouts.get('read_timeout', read_timeout)
+        if write_timeout is BaseRequest.DEFAULT_NONE:
+            write_timeout = timeouts.get('write_timeout', write_timeout)
+
+        if pool_timeout is BaseRequest.DEFAULT_NONE:
+            pool_timeout = self.pool_timeout
+
+        start = time.perf_counter()
+        self.stats['waiting'] += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), pool_timeout)
+        except asyncio.TimeoutError as exc:
+            raise TimedOut(f"Pool timeout: all {self.connection_pool_size} {self.name} connections are occupied") from exc
+        finally:
+            self.stats['waiting'] -= 1
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.stats['requests'] += 1
+        self.stats['pool_wait_ms_total'] += wait_ms
+        self.stats['pool_wait_ms_max'] = max(self.stats['pool_wait_ms_max'], wait_ms)
+        try:
+            return await super().do_request(
+                url, method, request_data,
+                read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        finally:
+            self._slots.release()
+
+    def get_stats(self):
+        stats = dict(self.stats, pool_size=self.connection_pool_size)
+        requests = stats['requests']
+        stats['pool_wait_ms_avg'] = stats['pool_wait_ms_total'] / requests if requests else 0.0
+        return stats
+
+
+def build_bot_requests(concurrent_updates, bulk_pool_size=4, http2=False):
+    # HTTP/2 multiplexes the requests of a pool over fewer connections
+    http_kwargs = {'http_version': "2" if http2 else "1.1"}
+    return {
+        # A single long poll is in flight at a time
+        'updates': PooledRequest("updates", 1, read_timeout=5.0, **http_kwargs),
+        # Each update handler sends its replies one after another; spare connections cover
+        # answers to callback/inline/pre-checkout queries arriving meanwhile
+        'interactive': PooledRequest(
+            "interactive", concurrent_updates + 4, method_timeouts=METHOD_TIMEOUTS, pool_timeout=5.0, **http_kwargs
+        ),
+        'bulk': PooledRequest(
+            "bulk", bulk_pool_size, method_timeouts=METHOD_TIMEOUTS, read_timeout=10.0, pool_timeout=60.0, **http_kwargs
+        ),
+    }
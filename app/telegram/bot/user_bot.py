@@ -1,53 +1,121 @@
+import asyncio
 import logging
 import json
 import pyqrcode
-import requests
+import httpx
 import datetime
+import time
+import re
 from telegram import (
-    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, LabeledPrice, InlineKeyboardButton,
-    InlineKeyboardMarkup, PhotoSize
+    Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, LabeledPrice, InlineKeyboardButton,
+    InlineKeyboardMarkup, PhotoSize, InlineQueryResultArticle, InputTextMessageContent
 )
 from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler,
     ConversationHandler, MessageHandler, StringCommandHandler,
-    filters, PreCheckoutQueryHandler, CallbackQueryHandler, CallbackContext,
+    filters, PreCheckoutQueryHandler, CallbackQueryHandler, CallbackContext, TypeHandler,
+    InlineQueryHandler,
 )
 import os
 from dotenv import load_dotenv
 from sys import platform
 from PIL import Image
+from bot_logging import setup_logging, bind_update_context, bind_handler, get_update_latency_ms
+from event_index import EventIndex, get_event_id
+from event_cards import EventCard, EventCardCache
+from metrics import add_metrics_handlers, get_transport_stats, start_metrics_server
+from mint_queue import MintQueue
+from transport import build_bot_requests
+from wallet_ledger import WalletLedger
 
 load_dotenv()
 
 
 TELE_TOKEN_TEST = os.getenv("TELE_TOKEN_TEST")
 PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")
+CURRENCY = os.getenv("CURRENCY", "SGD")
 endpoint_url = os.getenv("BACKEND_ENDPOINT", "http://localhost:3000")
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", 20))
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", 10)) # Seconds before a backend request is abandoned
+MINT_DB = os.getenv("MINT_DB", "mint_jobs.db")
+MINT_CONCURRENCY = int(os.getenv("MINT_CONCURRENCY", 4))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 1)) # Updates handled at the same time
+TELEGRAM_BULK_POOL_SIZE = int(os.getenv("TELEGRAM_BULK_POOL_SIZE", MINT_CONCURRENCY))
+TELEGRAM_HTTP2 = os.getenv("TELEGRAM_HTTP2") == "1"
+WALLET_RECONCILE_INTERVAL = int(os.getenv("WALLET_RECONCILE_INTERVAL", 300)) # Seconds between balance checks against the backend
 webhook_url = os.getenv("WEBHOOK_URL")
 PORT = int(os.environ.get('PORT', 5000))
-
-# Logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+EVENT_INDEX_TTL = int(os.getenv("EVENT_INDEX_TTL", 60)) # Seconds before the inline search catalogue is refreshed
+INLINE_PAGE_SIZE = 10
+FALLBACK_EVENT_PHOTO = PhotoSize(
+    file_id="https://ipfs.io/ipfs/QmfDTSqRjx1pgD1Jk6kfSyvGu1PhPc5GEx837ojK8wfGNi",
+    file_unique_id="some_random_id",
+    width=400,
+    height=400
 )
+TOPUP_AMOUNTS = (10, 50, 100)
+START_PAYLOAD_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Logging (set LOG_FORMAT=json for queued, structured & sampled logging)
+log_listener = setup_logging() # None unless LOG_FORMAT=json
 logger = logging.getLogger(__name__)
 
 
 
 ROUTE, NEW_USER, NEW_USER_NAME, SHOW_QR = range(4)
 
+DEFAULT_CONFIG = {
+    'provider_token': PROVIDER_TOKEN,
+    'endpoint_url': endpoint_url,
+    'currency': CURRENCY,
+    'mint_db': MINT_DB,
+}
+
+
+def get_config(context: ContextTypes.DEFAULT_TYPE):
+    # Per bot (tenant) configuration, see build_application
+    return context.bot_data.get("config", DEFAULT_CONFIG)
+
+
+def build_backend_client(endpoint_url):
+    # Each bot (tenant) gets its own pool of BACKEND_POOL_SIZE connections, so that a slow backend
+    # only holds up the requests of its own bot. Requests are async and never occupy a thread
+    limits = httpx.Limits(max_connections=BACKEND_POOL_SIZE, max_keepalive_connections=BACKEND_POOL_SIZE)
+    return httpx.AsyncClient(base_url=endpoint_url, timeout=BACKEND_TIMEOUT, limits=limits)
+
+
+async def backend_get(context: ContextTypes.DEFAULT_TYPE, path):
+    return await context.bot_data["backend"].get(path)
+
+
+async def backend_post(context: ContextTypes.DEFAULT_TYPE, path, data):
+    return await context.bot_data["backend"].post(path, json=data)
+
 """
 =============================================================================================
 start: Send bot description and provide user with wallet & event options, 
+    or jump straight to the step requested by a deep link payload (t.me/<bot>?start=<payload>)
+handle_start_payload: Route a deep link payload: ev_<event id> (registration), topup_<amount> (payment invoice) 
+    or redeem (ticket redemption). Returns None if the payload is not recognised
+get_start_link: Build the deep link for a payload, e.g. for marketing links & QR posters
 cancel: Exit current action
 unknown: User sends an unknown commad/message/invalid response
 error_handler: Error occured during execution and user is informed
+bind_update_logging: Tag log records with the update being handled (runs before all other handlers)
+log_update_handled: Log the handling latency of an update (runs after all other handlers, with LOG_FORMAT=json only
+    as plain logging writes on the event loop; the latency is also counted in GET /metrics)
+bind_handler_names: Wrap the callbacks of handlers (incl. conversation states) so logs carry the matched handler
 =============================================================================================
 """
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        state = await handle_start_payload(update, context, context.args[0])
+        if state is not None:
+            return state
+
     keyboard = [
         [InlineKeyboardButton("Wallet", callback_data="wallet_options"),],
         [InlineKeyboardButton("Event", callback_data="event_options"),]
@@ -78,6 +146,42 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ROUTE
 
 
+async def handle_start_payload(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    logger.info(f"Handling start payload {payload}")
+    user_id = update.effective_user.id
+
+    if payload.startswith("ev_"):
+        event = (await load_event_index(context)).get(payload[3:])
+        if event:
+            return await prompt_registration(update, context, user_id, event['title'], event['price'])
+
+    elif payload.startswith("topup_"):
+        amount = payload[6:]
+        if amount.isdigit() and int(amount) in TOPUP_AMOUNTS:
+            context.user_data["topup_amount"] = int(amount)
+            context.user_data["new_user"] = await is_new_user(context, user_id)
+            if context.user_data["new_user"] == True:
+                context.user_data["topup_from_link"] = True # Send the invoice once the user is registered
+                text=("To help us process your top-up, please provide your name in the following format: 'John'. \n"
+                      "This information is only required for your first top-up.")
+                await send_default_wallet_message(update, context, text)
+                return NEW_USER_NAME
+            await send_topup_invoice(update, context, int(amount))
+            return ROUTE
+
+    elif payload == "redeem":
+        return await redeem(update, context)
+
+    return None
+
+
+def get_start_link(bot_username, payload):
+    # Telegram only accepts up to 64 characters of A-Z, a-z, 0-9, _ and - as a start parameter
+    if not START_PAYLOAD_PATTERN.match(payload):
+        raise ValueError(f"Invalid start payload: {payload}")
+    return f"https://t.me/{bot_username}?start={payload}"
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id, 
@@ -104,12 +208,33 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     #     "Please try again later")
     return ConversationHandler.END
 
+
+async def bind_update_logging(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    bind_update_context(update.update_id, user.id if user else None)
+
+
+async def log_update_handled(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info(f"Update handled in {get_update_latency_ms()}ms")
+
+
+def bind_handler_names(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            bind_handler_names(handler.entry_points)
+            for state_handlers in handler.states.values():
+                bind_handler_names(state_handlers)
+            bind_handler_names(handler.fallbacks)
+        else:
+            handler.callback = bind_handler(handler.callback)
+
 """"
 =============================================================================================
 wallet_options: Modify the current text (start msg) and display wallet options
 event_options: Modify the current text (start msg) and display event options
 send_default_message: Send message displaying the text(variable) passed, as well as Menu option. There are also wallet and event variations of the same function which routes different "< Back" buttons
-update_default_message: Update the previous message with the text(variable) passed, as well as Menu Option. There are also wallet and event variations of the same function which routes different "< Back" buttons
+update_default_message: Update the previous message with the text(variable) passed, as well as Menu Option. There are also wallet and event variations of the same function which routes different "< Back" buttons.
+    When there is no previous message (e.g. reached from a /start link) a new message is sent instead
 =============================================================================================
 """
 
@@ -134,6 +259,7 @@ async def event_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     keyboard = [
         [InlineKeyboardButton("View Ongoing Events", callback_data="view_events"),],
+        [InlineKeyboardButton("Search Events", switch_inline_query_current_chat=""),],
         [InlineKeyboardButton("View Registration Status", callback_data="check_registration"),],
         [InlineKeyboardButton("Redeem Event Ticket", callback_data="redeem"),],
         [InlineKeyboardButton("< Back", callback_data="start"),],
@@ -176,6 +302,14 @@ async def update_default_event_message(update, context: ContextTypes.DEFAULT_TYP
     keyboard = [[InlineKeyboardButton("< Back to Menu", callback_data="event_options"),],]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
+    if not query: # Reached from a /start link, so there is no message to update
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown',
+        )
+        return
     await query.edit_message_text(
         text=text,
         reply_markup=reply_markup,
@@ -186,6 +320,14 @@ async def update_default_wallet_message(update, context: ContextTypes.DEFAULT_TY
     keyboard = [[InlineKeyboardButton("< Back to Menu", callback_data="wallet_options"),],]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
+    if not query: # Reached from a /start link, so there is no message to update
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown',
+        )
+        return
     await query.edit_message_text(
         text=text,
         reply_markup=reply_markup,
@@ -194,30 +336,58 @@ async def update_default_wallet_message(update, context: ContextTypes.DEFAULT_TY
 
 """"
 =============================================================================================
-get_user_id_from_query: Reusable function for retrieving user id after a user has clicked a button
+get_user_id_from_query: Reusable function for retrieving user id after a user has clicked a button (or opened a /start link)
+get_wallet_ledger: Return the local wallet ledger of the bot, hydrating the user's account from
+    /viewTransactionHistory & /viewWalletBalance on first use and reconciling it with /viewWalletBalance periodically
+    (or right away with reconcile=True)
+reconcile_wallet: Compare the local balance of a user with the backend balance & resync on drift
+record_transaction: Append a transaction made by the bot to the local wallet ledger
 view_wallet_balance: Display balance of user's wallet
 view_transaction_history: Display transaction history of user
 =============================================================================================
 """
 async def get_user_id_from_query(update):
     query = update.callback_query
+    if not query: # Reached from a /start link
+        return update.effective_user.id
     await query.answer()
     user_id = query.from_user.id
     return user_id
 
-async def view_wallet_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    loading_message = "Retrieving wallet balance..."
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
-
+async def get_wallet_ledger(context: ContextTypes.DEFAULT_TYPE, user_id, reconcile=False):
+    wallet_ledger = context.bot_data.setdefault("wallet_ledger", WalletLedger(WALLET_RECONCILE_INTERVAL))
+    if not wallet_ledger.is_hydrated(user_id):
+        logger.info(f"Loading wallet ledger for User: {user_id}")
+        # The balance is taken from the backend rather than summed from the history
+        history_response, balance_response = await asyncio.gather(
+            backend_get(context, f"/viewTransactionHistory/{user_id}"),
+            backend_get(context, f"/viewWalletBalance/{user_id}"),
+        )
+        wallet_ledger.hydrate(user_id, history_response.json(), balance=balance_response.json()['balance'])
+    elif reconcile or wallet_ledger.needs_reconcile(user_id):
+        await reconcile_wallet(context, wallet_ledger, user_id)
+    return wallet_ledger
+
+async def reconcile_wallet(context: ContextTypes.DEFAULT_TYPE, wallet_ledger, user_id):
+    logger.info(f"Reconciling wallet ledger for User: {user_id}")
+    response = await backend_get(context, f"/viewWalletBalance/{user_id}")
+    backend_balance = response.json()['balance']
+    if wallet_ledger.reconcile(user_id, backend_balance):
+        # Transactions were made outside of the bot (e.g. raffle refunds), reload them
+        response = await backend_get(context, f"/viewTransactionHistory/{user_id}")
+        wallet_ledger.hydrate(user_id, response.json(), balance=backend_balance)
+
+def record_transaction(context: ContextTypes.DEFAULT_TYPE, user_id, transaction):
+    wallet_ledger = context.bot_data.get("wallet_ledger")
+    if wallet_ledger:
+        wallet_ledger.record(user_id, transaction)
 
+async def view_wallet_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = await get_user_id_from_query(update)
     logger.info(f"Retrieving wallet balance for User: {user_id}")
-    response = requests.get(endpoint_url + f"/viewWalletBalance/{user_id}")
-    response_data = response.json()
-    user_balance = response_data['balance']
+    user_balance = (await get_wallet_ledger(context, user_id)).get_balance(user_id)
 
     text=f'Your wallet balance is ${user_balance}'
-    await message.delete()
     await update_default_wallet_message(update, context, text)
     return ROUTE
 
@@ -240,18 +410,15 @@ def format_txn_history(response_data):
     return text
     
 async def view_transaction_history(update: Update, context: CallbackContext):
-    loading_message = "Retrieving transaction history..."
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     
     logger.info(f"Retrieving transaction history for User: {user_id}")
-    response = requests.get(endpoint_url + f"/viewTransactionHistory/{user_id}")
-    response_data = response.json()
+    response_data = (await get_wallet_ledger(context, user_id)).get_transactions(user_id)
 
-    # Reverse the order of the response_data list to show latest transactions first
-    response_data.reverse()
+    # Reverse the order of the transactions to show latest transactions first
+    response_data = response_data[::-1]
 
     # Get the current page number from user_data, default to page 1
     page_num = int(query.data.split("_")[-1])
@@ -267,7 +434,6 @@ async def view_transaction_history(update: Update, context: CallbackContext):
 
     # Format the transactions as text
     text = format_txn_history(transactions)
-    await message.delete()
 
     # Create the inline keyboard for pagination
     keyboard = [[InlineKeyboardButton("< Back to Menu", callback_data="wallet_options"),],]
@@ -292,9 +458,36 @@ redeem: Displays events that the user has successfully registered for and are ye
 check_authorisation (merchant): should be in the merchant side. we get the telegram id, 
     use getRegistrations Firebase to see what the user has registered for, compare to the current event 
     and send a message back to the user and authoriser saying {handle} has been verified for XX event
+start_mint_queue / stop_mint_queue: Start and stop the background NFT mint queue of the bot.
+    Mint notifications are sent by the bulk bot, so they do not compete with interactive replies
+enqueue_mint: Queue the minting of a user's NFT ticket for an event (repeated calls are coalesced).
+    The merchant raffle owns minting: it mints every winner and saves the mint_account on the registration.
+    The bot only queues a mint when a ticket without a mint_account is redeemed
 =============================================================================================
 """
 
+async def start_mint_queue(application):
+    config = application.bot_data["config"]
+    mint_queue = MintQueue(
+        config['mint_db'], config['endpoint_url'], application.bot_data["bulk_bot"],
+        concurrency=MINT_CONCURRENCY
+    )
+    await mint_queue.start()
+    application.bot_data["mint_queue"] = mint_queue
+
+
+async def stop_mint_queue(application):
+    mint_queue = application.bot_data.pop("mint_queue", None)
+    if mint_queue:
+        await mint_queue.stop()
+
+
+async def enqueue_mint(context: ContextTypes.DEFAULT_TYPE, user_id, event_title, chat_id):
+    mint_queue = context.bot_data.get("mint_queue")
+    if mint_queue and await mint_queue.enqueue(user_id, event_title, chat_id):
+        logger.info(f"Queued NFT mint for {user_id} ({event_title})")
+
+
 def get_successful_registrations(response_data):
     registered_events = {}
     reply_string = ''
@@ -318,7 +511,7 @@ async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
     user_id = await get_user_id_from_query(update)
     logger.info(f"Retrieving registrations for User: {user_id}")
-    response = requests.get(endpoint_url + f"/getRegistrations/{user_id}")
+    response = await backend_get(context, f"/getRegistrations/{user_id}")
     response_data = response.json()
 
     await message.delete()
@@ -337,6 +530,11 @@ async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_keyboard = [list(registered_events.keys())]
             # very important to key the information
             context.user_data['registered_events'] = registered_events
+            # Raffle winners are minted by the merchant app, which saves the mint_account on the registration
+            context.user_data['unminted_events'] = [
+                event['eventTitle'] for event in response_data
+                if event['eventTitle'] in registered_events and not event.get('mint_account')
+            ]
 
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, 
@@ -364,6 +562,8 @@ async def show_QR(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = pyqrcode.create(qr_information_str)
     url.png(f'./qr_codes/{user_id}.png', scale=6)
     await update.message.reply_photo(f'./qr_codes/{user_id}.png')
+    if ticket in context.user_data.get('unminted_events', []):
+        await enqueue_mint(context, user_id, ticket, user_chat_id)
     # add code to delete photo as well
     # current_path = os.getcwd()
     # if platform != 'darwin':  # windows
@@ -386,6 +586,7 @@ is_new_user: check whether a user is a new user
 register_new_user: send API request to save user records
 get_topup_amount: prompt user for top up amount
 proceed_payment: send payment invoice based on top up amount
+send_topup_invoice: send the payment invoice for a top up amount
 precheckout: Answer the PreQecheckoutQuery
 successful_payment: Confirms successful payment and sends API request to update relevant records
 =============================================================================================
@@ -394,7 +595,9 @@ successful_payment: Confirms successful payment and sends API request to update
 
 async def top_up_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = await get_user_id_from_query(update)
-    context.user_data["new_user"] = await is_new_user(user_id)
+    # A top-up from the menu picks its amount, even if an earlier topup_ link was abandoned during registration
+    context.user_data.pop("topup_from_link", None)
+    context.user_data["new_user"] = await is_new_user(context, user_id)
     if context.user_data["new_user"] == True:
         text=("To help us process your top-up, please provide your name in the following format: 'John'. \n"
               "This information is only required for your first top-up.")
@@ -411,8 +614,8 @@ async def get_new_user_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Nice! Please provide your contact number in the following format: '81818181'.")
     return NEW_USER
 
-async def is_new_user(user_id):
-    response = requests.get(endpoint_url + f"/getUserInfo/{user_id}")
+async def is_new_user(context: ContextTypes.DEFAULT_TYPE, user_id):
+    response = await backend_get(context, f"/getUserInfo/{user_id}")
     response_data = response.json()
     if response_data['name'] == "No Such User Exists":
         return True
@@ -436,10 +639,13 @@ async def register_new_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     logger.info(f'Saving records of new user {user_id}')
 
-    response = requests.post(endpoint_url + "/uploadUserInfo", json=data)
+    response = await backend_post(context, "/uploadUserInfo", data)
     if response.status_code == 200:
         await update.message.reply_text('Successfully saved your contact info')
-        await get_topup_amount(update, context)
+        if context.user_data.pop("topup_from_link", False):
+            await send_topup_invoice(update, context, context.user_data["topup_amount"])
+        else:
+            await get_topup_amount(update, context)
         return ROUTE
     else:
         await update.message.reply_text('An unexpected error occurred')
@@ -472,17 +678,20 @@ async def proceed_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = update.callback_query.data[7:] ## (top_up_xx) The amount starts from 7th index
     topup_amount = int(callback_data)
     context.user_data["topup_amount"] = topup_amount
+    await send_topup_invoice(update, context, topup_amount)
+    return ROUTE
 
+
+async def send_topup_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, topup_amount):
     await context.bot.send_invoice(
         chat_id=update.effective_chat.id,
         title=f"Top up Wallet",
         description="Topping up your Mynt wallet",
         payload="Custom-Payload",
-        provider_token=PROVIDER_TOKEN,
-        currency="SGD",
+        provider_token=get_config(context)['provider_token'],
+        currency=get_config(context)['currency'],
         prices=[LabeledPrice("Ticket Price", topup_amount * 100)]
     )
-    return ROUTE
     
 
 async def precheckout(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -508,8 +717,11 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
         'transaction_type': "TOP_UP",
         'timestamp': timestamp
     }
-    response = requests.post(endpoint_url + "/topUpWallet", json=data)
+    response = await backend_post(context, "/topUpWallet", data)
     if response.status_code == 200:
+        record_transaction(context, user_id, {
+            'transactionType': "TOP_UP", 'amount': topup_amount, 'timestamp': timestamp,
+        })
         text=f"You have successfully topped up ${topup_amount}!"
         await send_default_wallet_message(update, context, text)
 
@@ -519,10 +731,17 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 """"
 =============================================================================================
-view_events: View ongoing events
+format_event_text: Caption of an event. Pass escape=escape_event_field for a Markdown-safe caption
+render_event_card: Build the caption, keyboard & photo of an event (once per catalogue version, see get_event_cards)
+get_event_cards: Return the event cards shared by all users, re-rendering only events that changed
+view_events: View ongoing events from the event index (see load_event_index)
+get_event_index / load_event_index: Return the event search index. Once it is stale, load_event_index refreshes it
+    from /viewEvents in the background (refresh_event_index) and answers from the current index meanwhile
+search_events: Answer inline queries (@bot jazz) from the event search index
 check_registration: View status for users' registrations
 get_previous_registrations: API call to retrive previous registrations
-validate_registration: Validate event title and check previous registrations
+validate_registration: Look up the event of a Register button (ev_<event id>) and check previous registrations
+prompt_registration: Check previous registrations and prompt user for payment confirmation
 verify_balance: Check whether user has sufficient balance in in-app wallet
 complete_purchase: Send API request to save payment records
 complete_registration: Send API request to save registration records
@@ -549,90 +768,89 @@ async def check_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
     user_id = await get_user_id_from_query(update)
     logger.info(f'Checking status for {user_id}')
-    response = requests.get(endpoint_url + f"/getRegistrations/{user_id}")
+    response = await backend_get(context, f"/getRegistrations/{user_id}")
     response_data = response.json()
     text=format_registration_data(response_data)
     await message.delete()
     await update_default_event_message(update, context, text)
     return ROUTE
     
-def format_event_data(response_data, context: ContextTypes.DEFAULT_TYPE):
-    
-    event_array = [] # Contains message, button and photo to be sent for each event
-    events_dict = {} # Contains mapping of event titles and price, to be used in validate_registration
-    
-    for event in response_data:
-        event_title = event['title']
-        event_description = event['description']
-        event_time = event['time']
-        event_venue = event['venue']
-        event_price = event['price']
-        
-        text = f"Event Title: *{event_title}*\n" \
-                  f"Description: {event_description}\n" \
-                  f"Time: {event_time}\n" \
-                  f"Venue: {event_venue}\n" \
-                  f"Price: *{event_price}*\n\n"
-                    
-        keyboard = [[InlineKeyboardButton(text='Register for Event', callback_data=f'title_{event_title}')],]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        photo_url = f"https://firebasestorage.googleapis.com/v0/b/treehoppers-mynt.appspot.com/o/{event_title}{event_time}?alt=media&token=07ddd564-df85-49a5-836a-c63f0a4045d6"
-        # if is_valid_url(photo_url):
-        photo = PhotoSize(
-            file_id=photo_url,
-            file_unique_id="some_random_id",
-            width=400,
-            height=400
-        )
-        event_array.append((text, reply_markup, photo))
-        
-        events_dict[event_title] = event_price
-        
-    context.user_data["events_dict"] = events_dict
-    return event_array
+def format_event_text(event, escape=lambda value: value):
+    return f"Event Title: *{escape(event['title'])}*\n" \
+        f"Description: {escape(event['description'])}\n" \
+        f"Time: {escape(event['time'])}\n" \
+        f"Venue: {escape(event['venue'])}\n" \
+        f"Price: *{escape(event['price'])}*\n\n"
+
+def escape_event_field(value):
+    return escape_markdown(str(value))
+
+def render_event_card(event_id, event):
+    event_title = event['title']
+    event_time = event['time']
+
+    # Callback data is limited to 64 bytes, so the button carries the event id rather than the title
+    keyboard = [[InlineKeyboardButton(text='Register for Event', callback_data=f'ev_{event_id}')],]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    photo_url = f"https://firebasestorage.googleapis.com/v0/b/treehoppers-mynt.appspot.com/o/{event_title}{event_time}?alt=media&token=07ddd564-df85-49a5-836a-c63f0a4045d6"
+    # if is_valid_url(photo_url):
+    photo = PhotoSize(
+        file_id=photo_url,
+        file_unique_id="some_random_id",
+        width=400,
+        height=400
+    )
+    return EventCard(
+        event_id=event_id,
+        event=event,
+        caption=format_event_text(event),
+        escaped_caption=format_event_text(event, escape_event_field),
+        reply_markup=reply_markup,
+        photo=photo,
+    )
+
+def get_event_card_cache(context: ContextTypes.DEFAULT_TYPE):
+    return context.bot_data.setdefault("event_cards", EventCardCache(render_event_card))
+
+async def get_event_cards(context: ContextTypes.DEFAULT_TYPE):
+    return get_event_card_cache(context).get_cards(await load_event_index(context))
 
 async def view_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Retrieving Events Information")
 
-    # Send loading message to user
-    loading_message = "Loading events..."
-    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
+    # Send a loading message only while the catalogue is first fetched, cards are otherwise served from memory
+    message = None
+    if not get_event_index(context).updated_at:
+        loading_message = "Loading events..."
+        message = await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_message)
 
     query = update.callback_query
     await query.answer()
     
-    response = requests.get(endpoint_url + "/viewEvents")
-    response_data = response.json()
-    event_array = format_event_data(response_data, context)
-    await message.delete()
-    if len(event_array) == 0:
+    event_cards = await get_event_cards(context)
+    if message:
+        await message.delete()
+    if len(event_cards) == 0:
         await update_default_event_message(update, context, "There are currently no ongoing events to register for")
     
     else:
-        for text, reply_markup, photo in event_array:
+        for card in event_cards:
                 try:
                     await context.bot.send_photo(
                         chat_id=update.effective_chat.id, 
-                        photo=photo,
-                        caption=text, 
+                        photo=card.photo,
+                        caption=card.escaped_caption, 
                         parse_mode="markdown", 
-                        reply_markup=reply_markup
+                        reply_markup=card.reply_markup
                     )
                 except Exception as e:
                     logger.error(f"Error sending photo for event: {e}")
-                    fallback_url ="https://ipfs.io/ipfs/QmfDTSqRjx1pgD1Jk6kfSyvGu1PhPc5GEx837ojK8wfGNi"
-                    photo = PhotoSize(
-                        file_id=fallback_url,
-                        file_unique_id="some_random_id",
-                        width=400,
-                        height=400
-                    )
                     await context.bot.send_photo(
                         chat_id=update.effective_chat.id, 
-                        photo=photo,
-                        caption=text, 
+                        photo=FALLBACK_EVENT_PHOTO,
+                        caption=card.escaped_caption, 
                         parse_mode="markdown", 
-                        reply_markup=reply_markup
+                        reply_markup=card.reply_markup
                     )
         text = "Please click on the register button for the event you would like to register for."
         await send_default_event_message(update, context, text)
@@ -640,9 +858,61 @@ async def view_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ROUTE
 
 
-def get_previous_registrations(user_id, event_title):
+def get_event_index(context: ContextTypes.DEFAULT_TYPE):
+    return context.bot_data.setdefault("event_index", EventIndex())
+
+
+async def refresh_event_index(context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Refreshing event search index")
+    response = await backend_get(context, "/viewEvents")
+    get_event_index(context).update(response.json())
+
+
+async def load_event_index(context: ContextTypes.DEFAULT_TYPE):
+    event_index = get_event_index(context)
+    if not event_index.updated_at: # Nothing to answer from yet
+        await refresh_event_index(context)
+    elif time.monotonic() - event_index.updated_at > EVENT_INDEX_TTL:
+        # Answer from the current index and refresh it in the background
+        refresh_task = context.bot_data.get("event_index_refresh")
+        if refresh_task is None or refresh_task.done():
+            context.bot_data["event_index_refresh"] = context.application.create_task(refresh_event_index(context))
+    return event_index
+
+
+async def search_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    offset = int(query.offset or 0)
+    event_index = await load_event_index(context)
+    card_cache = get_event_card_cache(context)
+    events, next_offset = event_index.search(query.query, offset, INLINE_PAGE_SIZE)
+
+    results = []
+    for event in events:
+        event_id = get_event_id(event)
+        keyboard = [[InlineKeyboardButton(
+            text='Register for Event', url=get_start_link(context.bot.username, f"ev_{event_id}")
+        )],]
+        results.append(InlineQueryResultArticle(
+            id=event_id,
+            title=event['title'],
+            description=f"{event['time']} @ {event['venue']} - ${event['price']}",
+            input_message_content=InputTextMessageContent(
+                card_cache.get_card(event_index, event_id).escaped_caption, parse_mode="markdown"
+            ),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        ))
+
+    await query.answer(
+        results,
+        cache_time=EVENT_INDEX_TTL,
+        next_offset=str(next_offset) if next_offset is not None else "",
+    )
+
+
+async def get_previous_registrations(context: ContextTypes.DEFAULT_TYPE, user_id, event_title):
     logger.info(f'Checking previous registrations for {user_id}')
-    response = requests.get(endpoint_url + f"/getRegistrations/{user_id}")
+    response = await backend_get(context, f"/getRegistrations/{user_id}")
     response_data = response.json()
 
     # Save event titles for events that user has previously registered for
@@ -663,12 +933,17 @@ async def validate_registration(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()   
     
-    callback_data = update.callback_query.data ## (title_xx) The title starts from 5th index
-    event_title = callback_data[6:]
+    callback_data = update.callback_query.data ## (ev_xx) The event id starts from 3rd index
+    event = (await load_event_index(context)).get(callback_data[3:])
+    if event is None:
+        await send_default_event_message(update, context, "Sorry, this event is no longer available")
+        return ROUTE
+    return await prompt_registration(update, context, query.from_user.id, event['title'], event['price'])
+
+
+async def prompt_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, event_title, event_price):
     context.user_data["event_title"] = event_title
-    
-    user_id = query.from_user.id
-    double_registration = get_previous_registrations(user_id, event_title)
+    double_registration = await get_previous_registrations(context, user_id, event_title)
     if double_registration:
         text=("You have already registered for this event. \n"
             "You cannot register for the same event again.")
@@ -676,8 +951,6 @@ async def validate_registration(update: Update, context: ContextTypes.DEFAULT_TY
     
     else:
         # Prompt user for payment confirmation
-        events_dict = context.user_data["events_dict"]
-        event_price = events_dict[event_title]
         context.user_data["event_price"] = event_price
         keyboard = [
             [InlineKeyboardButton("< Back", callback_data="event_options")],
@@ -702,9 +975,10 @@ async def verify_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     context.user_data["user_id"] = user_id
     logger.info(f"Verifying balance for user {user_id}")
-    response = requests.get(endpoint_url + f"/viewWalletBalance/{user_id}")
-    response_data = response.json()
-    user_balance = response_data['balance']
+    # The ledger misses debits made elsewhere (other tenants, bot replicas) and /ticketSale does not check
+    # the balance, so purchases are always checked against the backend balance
+    wallet_ledger = await get_wallet_ledger(context, user_id, reconcile=True)
+    user_balance = wallet_ledger.get_balance(user_id)
     event_price = context.user_data["event_price"]
 
     # User has insufficient balance
@@ -734,9 +1008,12 @@ async def complete_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'timestamp': timestamp,
         'event_title': event_title,
     }
-    response = requests.post(endpoint_url + "/ticketSale", json=data)
+    response = await backend_post(context, "/ticketSale", data)
     logger.info("Saving payment records")
     if response.status_code == 200:
+        record_transaction(context, user_id, {
+            'transactionType': "SALE", 'amount': event_price, 'timestamp': timestamp, 'eventTitle': event_title,
+        })
         await context.bot.send_message(
             text=f"Your wallet balance has been updated successfully",
             chat_id=update.effective_chat.id
@@ -759,7 +1036,7 @@ async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TY
         'status': 'PENDING',
         'registration_time': registration_time,
     }
-    response = requests.post(endpoint_url + "/insertRegistration", json=data)
+    response = await backend_post(context, "/insertRegistration", data)
     if response.status_code == 200:
         text=(f"You have successfully registered for {event_title}. \n"
         "Please note that your registration does not guarantee a ticket, as we will be "
@@ -773,8 +1050,44 @@ async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TY
         return ConversationHandler.END
 
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TELE_TOKEN_TEST).build()
+async def post_init(application):
+    await application.bot_data["bulk_bot"].initialize()
+    await start_mint_queue(application)
+    if application.bot_data.get("serve_metrics"):
+        application.bot_data["metrics_server"] = start_metrics_server([application])
+
+
+async def post_shutdown(application):
+    if "metrics_server" in application.bot_data:
+        application.bot_data.pop("metrics_server").stop()
+    await stop_mint_queue(application)
+    await application.bot_data["bulk_bot"].shutdown()
+    await application.bot_data["backend"].aclose()
+    logger.info(f"Telegram transport stats: {get_transport_stats(application)}")
+
+
+def build_application(token, config=None, serve_metrics=False):
+    """Build the bot application for a token. config overrides DEFAULT_CONFIG for this bot only.
+    With serve_metrics, the bot serves its own GET /metrics (see metrics.py) while it runs"""
+    bot_requests = build_bot_requests(CONCURRENT_UPDATES, TELEGRAM_BULK_POOL_SIZE, TELEGRAM_HTTP2)
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .get_updates_request(bot_requests['updates'])
+        .request(bot_requests['interactive'])
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.bot_data["config"] = {**DEFAULT_CONFIG, **(config or {})}
+    application.bot_data["backend"] = build_backend_client(application.bot_data["config"]['endpoint_url'])
+    application.bot_data["bot_requests"] = bot_requests
+    application.bot_data["serve_metrics"] = serve_metrics
+    # Sends outside of update handling (e.g. mint notifications) use their own connection pool
+    application.bot_data["bulk_bot"] = Bot(token, request=bot_requests['bulk'], get_updates_request=bot_requests['bulk'])
+    application.add_handler(TypeHandler(Update, bind_update_logging), group=-1) # Logging context
+    add_metrics_handlers(application)
 
     conversation_handler = ConversationHandler(
         entry_points=[
@@ -794,7 +1107,7 @@ if __name__ == '__main__':
                 CallbackQueryHandler(event_options, pattern="^event_options$"),
                 CallbackQueryHandler(view_events, pattern="^view_events$"),
                 CallbackQueryHandler(check_registration, pattern="^check_registration$"),
-                CallbackQueryHandler(validate_registration, pattern="^title_(.*)$"), ## Can handle any callback pattern,
+                CallbackQueryHandler(validate_registration, pattern="^ev_(.*)$"), ## Can handle any callback pattern,
                 CallbackQueryHandler(verify_balance, pattern="^verify_balance$"),
                 CallbackQueryHandler(redeem, pattern="^redeem$"),
                 CommandHandler('start', start),
@@ -808,10 +1121,19 @@ if __name__ == '__main__':
     )
     application.add_handler(conversation_handler)
 
+    application.add_handler(InlineQueryHandler(search_events)) # Inline event search
     application.add_handler(PreCheckoutQueryHandler(precheckout)) # Payment Services
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment)) # Payment Services
     application.add_handler(MessageHandler(filters.TEXT, unknown)) # Unknown messages
+    bind_handler_names(application.handlers[0])
+    if log_listener: # Logging latency, only when records are written by the background listener
+        application.add_handler(TypeHandler(Update, log_update_handled), group=1)
     application.add_error_handler(error_handler) # Error handling
+    return application
+
+
+if __name__ == '__main__':
+    application = build_application(TELE_TOKEN_TEST, serve_metrics=True)
 
     if os.getenv("WEBHOOK_URL"):
         application.run_webhook(listen="0.0.0.0",
@@ -0,0 +1,78 @@
+import logging
+import time
+
+"""
+=============================================================================================
+WalletLedger: Local, append-only copy of each user's wallet transactions and balance so that the wallet
+    balance and transaction history can be shown without calling the backend. Purchases are still checked
+    against the backend balance, since the ledger cannot see debits made by other bots.
+    hydrate: Load a user's ledger from /viewTransactionHistory and /viewWalletBalance (once per user)
+    record: Append a transaction the bot performed (TOP_UP, SALE). Every call is applied: the backend accepted
+        the transaction, and two purchases in the same minute are distinct even if their fields are equal
+    needs_reconcile / reconcile: The backend remains the source of truth. Every reconcile_interval
+        seconds the local balance is compared with /viewWalletBalance; on drift an alert is logged
+        and the local balance is reset to the backend balance
+Transactions use the same fields as /viewTransactionHistory (transactionType, amount, timestamp, eventTitle).
+=============================================================================================
+"""
+
+logger = logging.getLogger(__name__)
+
+# Sign of each transaction type's effect on the wallet balance
+TRANSACTION_SIGNS = {"TOP_UP": 1, "REFUND": 1, "SALE": -1}
+
+
+class WalletLedger:
+    def __init__(self, reconcile_interval=300):
+        self.reconcile_interval = reconcile_interval
+        self.accounts = {}  # user id -> {'balance', 'transactions', 'reconciled_at'}
+        self.stats = {'hydrations': 0, 'reconciliations': 0, 'drifts': 0}
+
+    def is_hydrated(self, user_id):
+        return user_id in self.accounts
+
+    def hydrate(self, user_id, transactions, balance=None):
+        """(Re)load a user's ledger. balance defaults to the sum of the transactions"""
+        account = {'balance': 0, 'transactions': [], 'reconciled_at': time.monotonic()}
+        self.accounts[user_id] = account
+        for transaction in transactions:
+            self._append(account, transaction)
+        if balance is not None:
+            account['balance'] = balance
+        self.stats['hydrations'] += 1
+
+    def record(self, user_id, transaction):
+        """Append a transaction to a hydrated ledger. Returns False if it was not applied"""
+        account = self.accounts.get(user_id)
+        if account is None:
+            return False  # Picked up when the ledger is hydrated
+        self._append(account, transaction)
+        return True
+
+    def get_balance(self, user_id):
+        return self.accounts[user_id]['balance']
+
+    def get_transactions(self, user_id):
+        return self.accounts[user_id]['transactions']
+
+    def needs_reconcile(self, user_id):
+        return time.monotonic() - self.accounts[user_id]['reconciled_at'] > self.reconcile_interval
+
+    def reconcile(self, user_id, backend_balance):
+        """Compare with the backend balance and return the drift (backend - local)"""
+        account = self.accounts[user_id]
+        drift = backend_balance - account['balance']
+        account['reconciled_at'] = time.monotonic()
+        self.stats['reconciliations'] += 1
+        if drift:
+            self.stats['drifts'] += 1
+            logger.warning(
+                f"Wallet ledger drift for {user_id}: local balance {account['balance']}, "
+                f"backend balance {backend_balance} (drift {drift})"
+            )
+            account['balance'] = backend_balance
+        return drift
+
+    def _append(self, account, transaction):
+        account['transactions'].append(transaction)
+        account['balance'] += TRANSACTION_SIGNS.get(transaction['transactionType'], 0) * transaction['amount']